@@ -2,17 +2,52 @@
 Pipeline de embedding de documentos
 Gera embeddings dos textos convertidos e armazena no Qdrant
 """
+import hashlib
 import logging
-from typing import Dict, List, Any, Tuple
+import os
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Counter as CounterType, Dict, Iterable, Iterator, List, Any, Tuple
 from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams, PointStruct
+from qdrant_client.models import (
+    Datatype,
+    Distance,
+    FieldCondition,
+    Filter,
+    FilterSelector,
+    HasIdCondition,
+    MatchValue,
+    PointStruct,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    VectorParams,
+)
 from fastembed import TextEmbedding
+from numba import njit
+import numpy as np
 import uuid
 from datetime import datetime
 import json
 
 logger = logging.getLogger(__name__)
 
+# Quantidade de chunks enviados ao modelo por batch
+EMBED_BATCH = 64
+
+# Quantidade de pontos enviados ao Qdrant por upsert
+UPSERT_BATCH = 256
+
+# Threads consumidoras que fazem upsert no Qdrant
+UPSERT_WORKERS = 2
+
+# Máximo de batches aguardando upsert (backpressure sobre o embedding)
+UPSERT_QUEUE_SIZE = 4
+
 
 def generate_embeddings_and_upsert(
     texts_partitioned: Dict[str, str],
@@ -30,117 +65,361 @@ def generate_embeddings_and_upsert(
     """
     logger.info(f"Iniciando geração de embeddings para {len(texts_partitioned)} documentos")
     
-    # Configuração do cliente Qdrant
-    qdrant_client = QdrantClient(
-        host="localhost",
-        port=6333
-    )
-    
-    # Inicializar o modelo de embedding
-    embedding_model = TextEmbedding(model_name="BAAI/bge-small-en-v1.5")
+    # Modelo de embedding (carregado uma única vez por processo)
+    embedding_model = _embedder()
     
     # Configurações
     collection_name = "documents"
     vector_size = 384  # Tamanho do vetor para bge-small-en-v1.5
     
-    # Criar coleção se não existir
+    # Início da execução, usado nos relatórios
+    started_at = datetime.now().isoformat()
+    
+    # Estatísticas por documento: (filename, chunks) e (filename, erro)
+    processed: List[Tuple[str, int]] = []
+    failed: List[Tuple[str, str]] = []
+    
+    # Dividir todos os documentos em chunks numa única passada, guardando a
+    # origem de cada chunk (filename, chunk_index, total_chunks, byte_start, byte_end)
+    all_chunks: List[str] = []
+    provenance: List[Tuple[str, int, int, int, int]] = []
+    for filename, text_content in texts_partitioned.items():
+        try:
+            logger.info(f"Processando embeddings para: {filename}")
+            
+            # Dividir texto em chunks (se necessário)
+            chunks = _split_text_into_chunks(text_content, chunk_size=1000, overlap=200)
+            
+            all_chunks.extend(chunk for chunk, _, _ in chunks)
+            provenance.extend(
+                (filename, i, len(chunks), byte_start, byte_end)
+                for i, (_, byte_start, byte_end) in enumerate(chunks)
+            )
+            processed.append((filename, len(chunks)))
+            
+        except Exception as e:
+            logger.error(f"Erro ao processar {filename}: {e}")
+            failed.append((filename, str(e)))
+    
+    # Pontos aceitos pelo Qdrant por documento
+    upserted: CounterType[str] = Counter()
+    upsert_error = None
     try:
-        qdrant_client.get_collection(collection_name)
-        logger.info(f"Coleção '{collection_name}' já existe")
-    except Exception:
-        logger.info(f"Criando coleção '{collection_name}'")
-        qdrant_client.create_collection(
-            collection_name=collection_name,
-            vectors_config=VectorParams(size=vector_size, distance=Distance.COSINE)
+        # Ordenar chunks por tamanho para que cada batch tenha sequências
+        # parecidas e o modelo gaste menos com padding
+        order = sorted(range(len(all_chunks)), key=lambda k: len(all_chunks[k]))
+        # Gerador: o FastEmbed consome os chunks ordenados sob demanda
+        sorted_chunks = (all_chunks[k] for k in order)
+        
+        # Gerar embeddings e fazer upsert concorrente no Qdrant
+        _embed_and_upsert(
+            embedding_model, collection_name, vector_size, order, sorted_chunks, provenance,
+            upserted
         )
+        
+    except Exception as e:
+        logger.error(f"Erro ao gerar embeddings/upsert: {e}")
+        upsert_error = e
+    
+    # Só falha o documento que não teve todos os pontos gravados no Qdrant;
+    # os batches já aceitos antes de um erro continuam valendo
+    incomplete = [(f, n) for f, n in processed if upserted[f] != n]
+    processed = [(f, n) for f, n in processed if upserted[f] == n]
+    failed.extend(
+        (filename, f"{upserted[filename]}/{n_chunks} chunks gravados: {upsert_error}")
+        for filename, n_chunks in incomplete
+    )
+    
+    for filename, n_chunks in processed:
+        logger.info(f"Sucesso: {filename} -> {n_chunks} chunks")
+    
+    try:
+        # Remover pontos de ingestões anteriores que não existem mais
+        _delete_stale_points(collection_name, processed)
+    except Exception as e:
+        logger.error(f"Erro ao remover pontos antigos: {e}")
     
     # Relatórios
+    total_vectors_created = sum(n for _, n in processed)
+    
     embedding_report = {
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": started_at,
         "total_documents": len(texts_partitioned),
-        "processed_documents": [],
-        "failed_documents": [],
-        "total_vectors_created": 0,
-        "total_vectors_failed": 0
+        "processed_documents": [
+            {"filename": f, "chunks_created": n, "status": "success"}
+            for f, n in processed
+        ],
+        "failed_documents": [
+            {"filename": f, "error": error, "status": "failed"}
+            for f, error in failed
+        ],
+        "total_vectors_created": total_vectors_created,
+        "total_vectors_failed": len(failed)
     }
     
     collections_used = {
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": started_at,
         "collections": [collection_name],
         "collection_details": {
             collection_name: {
                 "vector_size": vector_size,
                 "distance_metric": "COSINE",
-                "documents_added": 0,
-                "vectors_added": 0
+                "documents_added": len(processed),
+                "vectors_added": total_vectors_created
             }
         }
     }
     
-    # Processar cada documento
-    for filename, text_content in texts_partitioned.items():
+    logger.info(f"Embedding concluído. Sucessos: {len(embedding_report['processed_documents'])}, "
+                f"Falhas: {len(embedding_report['failed_documents'])}")
+    
+    return embedding_report, collections_used
+
+
+@lru_cache(maxsize=1)
+def _embedder() -> TextEmbedding:
+    """
+    Modelo de embedding do processo atual, criado uma única vez
+    
+    A sessão ONNX usa todos os núcleos via threads, em vez de abrir um pool
+    de processos do FastEmbed a cada chamada de embed. No FastEmbed o
+    bge-small-en-v1.5 já é servido pelo export quantizado do Qdrant
+    (model_optimized.onnx), com otimização de grafo ORT_ENABLE_ALL.
+    """
+    return TextEmbedding(
+        model_name="BAAI/bge-small-en-v1.5",
+        threads=os.cpu_count(),
+        providers=["CPUExecutionProvider"]
+    )
+
+
+@lru_cache(maxsize=1)
+def _qdrant() -> QdrantClient:
+    """
+    Cliente do Qdrant do processo atual, reutilizado entre execuções
+    
+    Usa gRPC, que mantém uma única conexão HTTP/2 multiplexada para todos
+    os upserts, com um timeout folgado para batches grandes.
+    """
+    return QdrantClient(
+        host="localhost",
+        port=6333,
+        grpc_port=6334,
+        prefer_grpc=True,
+        timeout=60
+    )
+
+
+def _embed_and_upsert(
+    embedding_model: TextEmbedding,
+    collection_name: str,
+    vector_size: int,
+    order: List[int],
+    sorted_chunks: Iterable[str],
+    provenance: List[Tuple[str, int, int, int, int]],
+    upserted: CounterType[str]
+) -> None:
+    """
+    Gera os embeddings e faz upsert no Qdrant em estágios sobrepostos
+    
+    A thread atual consome o gerador do FastEmbed e coloca batches de
+    pontos numa fila limitada; UPSERT_WORKERS threads retiram os batches
+    e fazem o upsert (wait=False), de modo que a escrita na rede acontece
+    enquanto o próximo batch é gerado. O último batch é enviado com
+    wait=True depois que os consumidores terminam, como flush confirmado.
+    
+    Args:
+        embedding_model: Modelo de embedding
+        collection_name: Nome da coleção
+        vector_size: Tamanho do vetor
+        order: Índice original (em all_chunks) de cada chunk ordenado
+        sorted_chunks: Chunks ordenados por tamanho
+        provenance: Origem (filename, chunk_index, total_chunks, byte_start, byte_end)
+            de cada chunk
+        upserted: Contador atualizado com os pontos aceitos por filename
+    """
+    qdrant_client = _qdrant()
+    
+    # Criar coleção se não existir
+    try:
+        qdrant_client.get_collection(collection_name)
+        logger.info(f"Coleção '{collection_name}' já existe")
+    except Exception:
+        logger.info(f"Criando coleção '{collection_name}'")
+        qdrant_client.create_collection(
+            collection_name=collection_name,
+            vectors_config=VectorParams(
+                size=vector_size,
+                distance=Distance.COSINE,
+                on_disk=True,
+                datatype=Datatype.FLOAT16
+            ),
+            # Vetores originais ficam em disco (float16); a busca usa a cópia int8 em RAM
+            quantization_config=ScalarQuantization(
+                scalar=ScalarQuantizationConfig(type=ScalarType.INT8, always_ram=True)
+            )
+        )
+    
+    batches = queue.Queue(maxsize=UPSERT_QUEUE_SIZE)
+    errors: List[Exception] = []
+    lock = threading.Lock()
+    
+    def _upsert(batch: List[PointStruct], wait: bool) -> None:
+        qdrant_client.upsert(
+            collection_name=collection_name,
+            points=batch,
+            wait=wait
+        )
+        with lock:
+            upserted.update(point.payload["filename"] for point in batch)
+    
+    def _consume() -> None:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            # Após uma falha, só esvazia a fila para não travar o produtor
+            if errors:
+                continue
+            try:
+                _upsert(batch, wait=False)
+            except Exception as e:
+                errors.append(e)
+    
+    with ThreadPoolExecutor(max_workers=UPSERT_WORKERS) as executor:
+        for _ in range(UPSERT_WORKERS):
+            executor.submit(_consume)
+        
         try:
-            logger.info(f"Processando embeddings para: {filename}")
-            
-            # Dividir texto em chunks (se necessário)
-            chunks = _split_text_into_chunks(text_content, chunk_size=1000, overlap=200)
+            # Gerar embeddings de todos os chunks numa única chamada; o gerador
+            # do FastEmbed é consumido direto, batch a batch, sem virar lista
+            embeddings_iter = embedding_model.embed(sorted_chunks, batch_size=EMBED_BATCH)
+            points_iter = _build_points(order, provenance, embeddings_iter)
             
-            points = []
-            for i, chunk in enumerate(chunks):
-                # Gerar embedding para o chunk
-                embedding = list(embedding_model.embed([chunk]))[0]
-                
-                # Criar ponto para o Qdrant
-                point_id = str(uuid.uuid4())
-                point = PointStruct(
-                    id=point_id,
-                    vector=embedding,
-                    payload={
-                        "filename": filename,
-                        "chunk_index": i,
-                        "text": chunk,
-                        "total_chunks": len(chunks),
-                        "source": "pdf_conversion",
-                        "created_at": datetime.now().isoformat()
-                    }
-                )
-                points.append(point)
-            
-            # Fazer upsert no Qdrant
-            qdrant_client.upsert(
-                collection_name=collection_name,
-                points=points
+            # Enviar cada batch assim que sai do gerador, independente da
+            # fronteira entre documentos; o último fica retido para o flush final
+            last_batch = list(islice(points_iter, UPSERT_BATCH))
+            while last_batch and not errors:
+                batch = list(islice(points_iter, UPSERT_BATCH))
+                if not batch:
+                    break
+                batches.put(last_batch)
+                last_batch = batch
+        finally:
+            for _ in range(UPSERT_WORKERS):
+                batches.put(None)
+    
+    if errors:
+        raise errors[0]
+    
+    # Flush final confirmado: enviado após todos os upserts anteriores serem
+    # aceitos, só retorna quando o Qdrant aplicou as escritas da coleção
+    if last_batch:
+        _upsert(last_batch, wait=True)
+
+
+def _delete_stale_points(collection_name: str, processed: List[Tuple[str, int]]) -> None:
+    """
+    Remove os pontos de cada documento que não fazem parte desta ingestão
+    
+    Apaga, por filename, todo ponto cujo id não é um dos ids desta execução:
+    chunks além do número atual (re-ingestão com menos chunks, com offsets
+    que não valem mais para o txt reescrito) e pontos de ingestões antigas
+    com ids uuid4 aleatórios.
+    
+    Args:
+        collection_name: Nome da coleção
+        processed: Lista de (filename, chunks) dos documentos ingeridos
+    """
+    if not processed:
+        return
+    
+    _qdrant().delete(
+        collection_name=collection_name,
+        points_selector=FilterSelector(
+            filter=Filter(
+                should=[
+                    Filter(
+                        must=[FieldCondition(key="filename", match=MatchValue(value=filename))],
+                        must_not=[HasIdCondition(
+                            has_id=[_point_id(filename, i) for i in range(n_chunks)]
+                        )]
+                    )
+                    for filename, n_chunks in processed
+                ]
             )
-            
-            # Atualizar relatórios
-            embedding_report["processed_documents"].append({
-                "filename": filename,
-                "chunks_created": len(chunks),
-                "status": "success"
-            })
-            embedding_report["total_vectors_created"] += len(chunks)
-            
-            collections_used["collection_details"][collection_name]["documents_added"] += 1
-            collections_used["collection_details"][collection_name]["vectors_added"] += len(chunks)
-            
-            logger.info(f"Sucesso: {filename} -> {len(chunks)} chunks")
-            
-        except Exception as e:
-            logger.error(f"Erro ao processar {filename}: {e}")
-            embedding_report["failed_documents"].append({
+        ),
+        wait=True
+    )
+
+
+def _build_points(
+    order: List[int],
+    provenance: List[Tuple[str, int, int, int, int]],
+    embeddings: Iterable[Any]
+) -> Iterator[PointStruct]:
+    """
+    Monta os pontos do Qdrant a partir dos embeddings dos chunks ordenados
+    
+    Cada ponto carrega sua origem no payload, então não é preciso
+    restaurar a ordem original dos embeddings. O texto do chunk não vai no
+    payload: ele é lido do txt no S3 pelos offsets (ver load_chunk_text).
+    
+    Args:
+        order: Índice original (em all_chunks) de cada chunk ordenado
+        provenance: Origem (filename, chunk_index, total_chunks, byte_start, byte_end)
+            de cada chunk
+        embeddings: Embeddings na mesma ordem de sorted_chunks
+    
+    Returns:
+        Iterador de PointStruct
+    """
+    # Mesmo timestamp para todos os pontos da execução
+    now_iso = datetime.now().isoformat()
+    
+    for k, embedding in zip(order, embeddings):
+        filename, i, total_chunks, byte_start, byte_end = provenance[k]
+        
+        # Criar ponto para o Qdrant (id estável permite re-ingestão idempotente)
+        point_id = _point_id(filename, i)
+        yield PointStruct(
+            id=point_id,
+            vector=embedding,
+            payload={
                 "filename": filename,
-                "error": str(e),
-                "status": "failed"
-            })
-            embedding_report["total_vectors_failed"] += 1
+                "chunk_index": i,
+                "byte_start": byte_start,
+                "byte_end": byte_end,
+                "total_chunks": total_chunks,
+                "source": "pdf_conversion",
+                "created_at": now_iso
+            }
+        )
+
+
+def _point_id(filename: str, chunk_index: int) -> str:
+    """
+    Gera um id determinístico para o chunk a partir de (filename, chunk_index)
     
-    logger.info(f"Embedding concluído. Sucessos: {len(embedding_report['processed_documents'])}, "
-                f"Falhas: {len(embedding_report['failed_documents'])}")
+    Args:
+        filename: Nome do documento
+        chunk_index: Índice do chunk no documento
     
-    return embedding_report, collections_used
+    Returns:
+        UUID derivado do hash BLAKE2b de 128 bits
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(filename.encode('utf-8'))
+    h.update(b":")
+    h.update(chunk_index.to_bytes(4, "big"))
+    return str(uuid.UUID(bytes=h.digest()))
 
 
-def _split_text_into_chunks(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
+def _split_text_into_chunks(
+    text: str,
+    chunk_size: int = 1000,
+    overlap: int = 200
+) -> List[Tuple[str, int, int]]:
     """
     Divide o texto em chunks com sobreposição
     
@@ -150,32 +429,142 @@ def _split_text_into_chunks(text: str, chunk_size: int = 1000, overlap: int = 20
         overlap: Sobreposição entre chunks
     
     Returns:
-        Lista de chunks de texto
+        Lista de (chunk, byte_start, byte_end), com os offsets em bytes do
+        chunk no texto codificado em UTF-8
     """
     if len(text) <= chunk_size:
-        return [text]
+        return [(text, 0, len(text.encode('utf-8')))]
     
-    chunks = []
-    start = 0
+    # UTF-32 mantém um code point por índice do str original
+    codepoints = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
     
-    while start < len(text):
-        end = start + chunk_size
-        
-        # Se não é o último chunk, tenta quebrar em uma palavra
-        if end < len(text):
-            # Procura por um espaço próximo ao final
-            space_pos = text.rfind(' ', start, end)
-            if space_pos > start:
-                end = space_pos
-        
-        chunk = text[start:end].strip()
+    # Posições dos espaços calculadas de uma vez com comparação vetorizada
+    space_idx = np.flatnonzero(codepoints == 0x20)
+    starts, ends = _chunk_offsets(space_idx, len(text), chunk_size, overlap)
+    
+    # Remover espaços das pontas de cada chunk, ajustando os offsets
+    chunks = []
+    spans = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        raw = text[start:end]
+        stripped = raw.lstrip()
+        start += len(raw) - len(stripped)
+        chunk = stripped.rstrip()
         if chunk:
             chunks.append(chunk)
-        
-        # Move o início para o próximo chunk com sobreposição
-        start = end - overlap if end < len(text) else end
+            spans.append((start, start + len(chunk)))
+    
+    # Offset em bytes UTF-8 de cada fronteira de chunk, acumulando o tamanho
+    # codificado de cada trecho entre fronteiras consecutivas
+    byte_at = {}
+    prev = 0
+    total = 0
+    for pos in sorted({pos for span in spans for pos in span}):
+        total += len(text[prev:pos].encode('utf-8'))
+        byte_at[pos] = total
+        prev = pos
     
-    return chunks
+    return [
+        (chunk, byte_at[start], byte_at[end])
+        for chunk, (start, end) in zip(chunks, spans)
+    ]
+
+
+@njit(cache=True)
+def _next_chunk(
+    space_idx: np.ndarray,
+    n: int,
+    start: int,
+    chunk_size: int,
+    overlap: int
+) -> Tuple[int, int]:
+    """
+    Calcula o fim do chunk que começa em start e o início do próximo
+    """
+    end = start + chunk_size
+    
+    # Se não é o último chunk, tenta quebrar em uma palavra
+    if end < n:
+        # Último espaço antes do final, por busca binária nas posições
+        pos = np.searchsorted(space_idx, end) - 1
+        if pos >= 0 and space_idx[pos] > start:
+            end = space_idx[pos]
+    else:
+        end = n
+    
+    # Move o início para o próximo chunk com sobreposição, sem andar para trás
+    next_start = end - overlap if end < n else end
+    if next_start <= start:
+        next_start = end
+    
+    return end, next_start
+
+
+@njit(cache=True)
+def _chunk_offsets(
+    space_idx: np.ndarray,
+    n: int,
+    chunk_size: int,
+    overlap: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calcula os offsets (início, fim) dos chunks sobre os índices do texto
+    
+    Args:
+        space_idx: Posições (ordenadas) dos espaços no texto
+        n: Tamanho do texto
+        chunk_size: Tamanho máximo de cada chunk
+        overlap: Sobreposição entre chunks
+    
+    Returns:
+        Tupla com os arrays de inícios e fins dos chunks
+    """
+    # Primeira passada conta os chunks para alocar a saída de uma vez
+    count = 0
+    start = 0
+    while start < n:
+        _, start = _next_chunk(space_idx, n, start, chunk_size, overlap)
+        count += 1
+    
+    starts = np.empty(count, dtype=np.int64)
+    ends = np.empty(count, dtype=np.int64)
+    start = 0
+    for k in range(count):
+        starts[k] = start
+        ends[k], start = _next_chunk(space_idx, n, start, chunk_size, overlap)
+    
+    return starts, ends
+
+
+def load_chunk_text(s3_client: Any, bucket_name: str, payload: Dict[str, Any]) -> str:
+    """
+    Recupera o texto de um chunk a partir do payload de um ponto do Qdrant
+    
+    Lê apenas o intervalo de bytes do chunk no txt gerado pelo pipeline
+    de extract (intermedio/txt/{filename}.txt). Pontos de ingestões antigas
+    ainda trazem o texto no próprio payload e não têm offsets.
+    
+    Args:
+        s3_client: Cliente S3 (boto3)
+        bucket_name: Nome do bucket S3 com os textos convertidos
+        payload: Payload do ponto, com filename, byte_start e byte_end
+            (ou text, nos pontos antigos)
+    
+    Returns:
+        Texto do chunk
+    """
+    if "text" in payload:
+        return payload["text"]
+    
+    if payload["byte_end"] <= payload["byte_start"]:
+        return ""
+    
+    response = s3_client.get_object(
+        Bucket=bucket_name,
+        Key=f"intermedio/txt/{payload['filename']}.txt",
+        Range=f"bytes={payload['byte_start']}-{payload['byte_end'] - 1}"
+    )
+    return response['Body'].read().decode('utf-8')
 
 
 def generate_execution_reports(
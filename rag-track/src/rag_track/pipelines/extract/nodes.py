@@ -3,17 +3,30 @@ Pipeline de extração de documentos PDF
 Converte PDFs armazenados no S3 para arquivos de texto usando docling
 """
 import logging
-from typing import Dict, List, Any
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Any, Optional, Tuple
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from docling.document_converter import DocumentConverter
-from docling.datamodel.base_models import InputFormat
-import tempfile
+from docling.datamodel.base_models import DocumentStream, InputFormat
+from io import BytesIO
 import os
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
+# Máximo de PDFs baixados (ou baixando) ainda não enviados à conversão
+PREFETCH_PDFS = 8
+
+# Threads que baixam PDFs do S3 em paralelo; cada download ocupa um slot de
+# prefetch, então threads além de PREFETCH_PDFS ficariam só esperando
+DOWNLOAD_WORKERS = PREFETCH_PDFS
+
 
 def list_pdfs_from_s3(bucket_name: str = "meu-bucket", prefix: str = "raw/pdfs/") -> List[str]:
     """
@@ -29,13 +42,7 @@ def list_pdfs_from_s3(bucket_name: str = "meu-bucket", prefix: str = "raw/pdfs/"
     logger.info(f"Listando PDFs no bucket {bucket_name} com prefixo {prefix}")
     
     try:
-        # Configuração do cliente S3 para MinIO
-        s3_client = boto3.client(
-            's3',
-            endpoint_url='http://192.168.0.48:9300',
-            aws_access_key_id='minioadmin',
-            aws_secret_access_key='minioadmin'
-        )
+        s3_client = _s3_client()
         
         # Lista objetos no bucket
         response = s3_client.list_objects_v2(
@@ -66,6 +73,12 @@ def convert_pdfs_to_text(pdf_files: List[str], bucket_name: str = "meu-bucket")
     """
     Node 2: Converte PDFs para arquivos de texto usando docling
     
+    Os PDFs são baixados por um pool de threads (rede) e convertidos em
+    paralelo num pool de processos, já que a conversão do docling (OCR,
+    layout) é pesada em CPU. Os downloads se sobrepõem à conversão, mas a
+    memória fica limitada a PREFETCH_PDFS PDFs baixados mais os que estão
+    em conversão (um por worker).
+    
     Args:
         pdf_files: Lista de chaves dos arquivos PDF no S3
         bucket_name: Nome do bucket S3
@@ -77,17 +90,6 @@ def convert_pdfs_to_text(pdf_files: List[str], bucket_name: str = "meu-bucket")
     """
     logger.info(f"Iniciando conversão de {len(pdf_files)} PDFs")
     
-    # Configuração do cliente S3
-    s3_client = boto3.client(
-        's3',
-        endpoint_url='http://192.168.0.48:9300',
-        aws_access_key_id='minioadmin',
-        aws_secret_access_key='minioadmin'
-    )
-    
-    # Inicializar o conversor docling
-    converter = DocumentConverter()
-    
     texts_data = {}
     converted_index = {
         "converted_files": [],
@@ -97,59 +99,96 @@ def convert_pdfs_to_text(pdf_files: List[str], bucket_name: str = "meu-bucket")
         "total_failed": 0
     }
     
-    for pdf_key in pdf_files:
+    max_workers = max(1, (os.cpu_count() or 1) - 1)
+    
+    # PDFs baixados (ou baixando) aguardando conversão e conversões em andamento;
+    # cada download só começa com um slot de prefetch livre, liberado quando o
+    # node retira o PDF da fila
+    fetched = queue.Queue()
+    prefetch = threading.Semaphore(PREFETCH_PDFS)
+    slots = threading.Semaphore(max_workers)
+    aborted = threading.Event()
+    
+    # Criar o cliente S3 uma única vez na thread do node: o lru_cache não
+    # trava um cache miss e o boto3 não cria clientes em paralelo com segurança
+    _s3_client()
+    
+    def _fetch(pdf_key: str) -> None:
+        prefetch.acquire()
+        if aborted.is_set():
+            prefetch.release()
+            return
         try:
-            logger.info(f"Processando: {pdf_key}")
-            
-            # Baixar PDF do S3 para arquivo temporário
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp_pdf:
-                s3_client.download_file(bucket_name, pdf_key, temp_pdf.name)
-                
-                # Converter PDF para texto usando docling
-                result = converter.convert(temp_pdf.name)
-                
-                # Extrair texto do resultado
-                text_content = result.document.export_to_markdown()
-                
-                # Gerar nome do arquivo de saída
-                pdf_filename = Path(pdf_key).stem
-                output_key = f"intermedio/txt/{pdf_filename}.txt"
+            fetched.put((pdf_key, _download_pdf(pdf_key, bucket_name), None))
+        except Exception as e:
+            fetched.put((pdf_key, None, e))
+    
+    # Workers via spawn: não herdam o cliente S3 (e suas conexões) do processo
+    # pai nem fazem fork enquanto as threads de download estão ativas
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_warm
+    ) as converters, ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as downloads:
+        pending = [downloads.submit(_fetch, pdf_key) for pdf_key in pdf_files]
+        
+        conversions: Dict[str, Future] = {}
+        try:
+            for _ in range(len(pdf_files)):
+                pdf_key, body, error = fetched.get()
+                prefetch.release()
                 
-                # Salvar texto no S3
-                s3_client.put_object(
-                    Bucket=bucket_name,
-                    Key=output_key,
-                    Body=text_content.encode('utf-8'),
-                    ContentType='text/plain'
-                )
+                if error is not None:
+                    logger.error(f"Erro ao baixar {pdf_key}: {error}")
+                    conversions[pdf_key] = _completed(_failed_result(pdf_key, error))
+                    continue
                 
+                # Só envia ao pool quando há worker livre, para limitar a memória
+                slots.acquire()
+                try:
+                    future = converters.submit(_convert_one, pdf_key, body, bucket_name)
+                except Exception as e:
+                    slots.release()
+                    logger.error(f"Erro ao converter {pdf_key}: {e}")
+                    future = _completed(_failed_result(pdf_key, e))
+                else:
+                    future.add_done_callback(lambda _: slots.release())
+                conversions[pdf_key] = future
+        except BaseException:
+            # Esvaziar a fila (liberando os slots de prefetch) até os downloads
+            # em andamento terminarem, senão as threads ficam presas esperando
+            # um slot e o node nunca sai
+            aborted.set()
+            for download in pending:
+                download.cancel()
+            while not all(download.done() for download in pending):
+                try:
+                    fetched.get(timeout=0.1)
+                    prefetch.release()
+                except queue.Empty:
+                    pass
+            raise
+        
+        for pdf_key in pdf_files:
+            try:
+                pdf_filename, text_content, index_record = conversions[pdf_key].result()
+            except Exception as e:
+                # Ex.: BrokenProcessPool quando um worker do docling morre
+                logger.error(f"Erro ao converter {pdf_key}: {e}")
+                pdf_filename, text_content, index_record = _failed_result(pdf_key, e)
+            
+            if index_record["status"] == "success":
                 # Armazenar dados para o dataset particionado
                 texts_data[pdf_filename] = text_content
                 
                 # Atualizar índice
-                converted_index["converted_files"].append({
-                    "original_pdf": pdf_key,
-                    "output_txt": output_key,
-                    "filename": pdf_filename,
-                    "status": "success"
-                })
+                converted_index["converted_files"].append(index_record)
                 converted_index["total_successful"] += 1
-                
-                logger.info(f"Convertido com sucesso: {pdf_key} -> {output_key}")
-                
-            # Limpar arquivo temporário
-            os.unlink(temp_pdf.name)
+            else:
+                converted_index["failed_files"].append(index_record)
+                converted_index["total_failed"] += 1
             
-        except Exception as e:
-            logger.error(f"Erro ao converter {pdf_key}: {e}")
-            converted_index["failed_files"].append({
-                "original_pdf": pdf_key,
-                "error": str(e),
-                "status": "failed"
-            })
-            converted_index["total_failed"] += 1
-        
-        converted_index["total_processed"] += 1
+            converted_index["total_processed"] += 1
     
     logger.info(f"Conversão concluída. Sucessos: {converted_index['total_successful']}, "
                 f"Falhas: {converted_index['total_failed']}")
@@ -157,4 +196,131 @@ def convert_pdfs_to_text(pdf_files: List[str], bucket_name: str = "meu-bucket")
     return {
         "texts_partitioned": texts_data,
         "converted_index": converted_index
-    }
\ No newline at end of file
+    }
+
+
+@lru_cache(maxsize=1)
+def _s3_client():
+    """
+    Cliente S3 do processo atual, criado uma única vez por processo
+    
+    O pool de conexões comporta todas as threads de download, que
+    compartilham este cliente.
+    """
+    # Configuração do cliente S3 para MinIO
+    return boto3.client(
+        's3',
+        endpoint_url='http://192.168.0.48:9300',
+        aws_access_key_id='minioadmin',
+        aws_secret_access_key='minioadmin',
+        config=Config(max_pool_connections=DOWNLOAD_WORKERS)
+    )
+
+
+@lru_cache(maxsize=1)
+def _converter() -> DocumentConverter:
+    """
+    Conversor docling do processo atual, criado uma única vez por worker
+    """
+    return DocumentConverter()
+
+
+def _warm() -> None:
+    """
+    Inicializa o cliente S3 e o conversor docling ao subir cada worker
+    """
+    _s3_client()
+    _converter()
+
+
+def _download_pdf(pdf_key: str, bucket_name: str) -> bytes:
+    """
+    Baixa um PDF do S3 direto para memória
+    
+    Args:
+        pdf_key: Chave do arquivo PDF no S3
+        bucket_name: Nome do bucket S3
+    
+    Returns:
+        Conteúdo do PDF
+    """
+    return _s3_client().get_object(Bucket=bucket_name, Key=pdf_key)['Body'].read()
+
+
+def _completed(result: Tuple[str, Optional[str], Dict[str, Any]]) -> Future:
+    """
+    Embrulha um resultado já conhecido num Future concluído
+    """
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _failed_result(pdf_key: str, error: Exception) -> Tuple[str, None, Dict[str, Any]]:
+    """
+    Monta o resultado de um PDF que não pôde ser convertido
+    """
+    return Path(pdf_key).stem, None, {
+        "original_pdf": pdf_key,
+        "error": str(error),
+        "status": "failed"
+    }
+
+
+def _convert_one(
+    pdf_key: str,
+    body: bytes,
+    bucket_name: str
+) -> Tuple[str, Optional[str], Dict[str, Any]]:
+    """
+    Converte um único PDF para texto e salva o resultado no S3
+    
+    Roda dentro dos workers do pool de processos, por isso fica no nível
+    do módulo e só recebe argumentos serializáveis.
+    
+    Args:
+        pdf_key: Chave do arquivo PDF no S3
+        body: Conteúdo do PDF já baixado
+        bucket_name: Nome do bucket S3
+    
+    Returns:
+        Tupla com (pdf_filename, text_content, index_record); text_content
+        é None quando a conversão falha
+    """
+    pdf_filename = Path(pdf_key).stem
+    
+    try:
+        logger.info(f"Processando: {pdf_key}")
+        
+        s3_client = _s3_client()
+        converter = _converter()
+        
+        # Converter PDF para texto usando docling
+        result = converter.convert(DocumentStream(name=Path(pdf_key).name, stream=BytesIO(body)))
+        
+        # Extrair texto do resultado
+        text_content = result.document.export_to_markdown()
+        
+        # Gerar nome do arquivo de saída
+        output_key = f"intermedio/txt/{pdf_filename}.txt"
+        
+        # Salvar texto no S3
+        s3_client.put_object(
+            Bucket=bucket_name,
+            Key=output_key,
+            Body=text_content.encode('utf-8'),
+            ContentType='text/plain'
+        )
+        
+        logger.info(f"Convertido com sucesso: {pdf_key} -> {output_key}")
+        
+        return pdf_filename, text_content, {
+            "original_pdf": pdf_key,
+            "output_txt": output_key,
+            "filename": pdf_filename,
+            "status": "success"
+        }
+        
+    except Exception as e:
+        logger.error(f"Erro ao converter {pdf_key}: {e}")
+        return _failed_result(pdf_key, e)
@@ -7,3 +7,249 @@ Kedro recommends using `pytest` framework, more info about it can be found
 in the official documentation:
 https://docs.pytest.org/en/latest/getting-started.html
 """
+import io
+import random
+import threading
+import uuid
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from rag_track.pipelines.embedding import nodes
+from rag_track.pipelines.embedding.nodes import (
+    _point_id,
+    _split_text_into_chunks,
+    load_chunk_text,
+)
+
+
+def _rfind_chunks(text, chunk_size=1000, overlap=200):
+    # Algoritmo original baseado em str.rfind, usado como referência
+    if len(text) <= chunk_size:
+        return [text]
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        if end < len(text):
+            space_pos = text.rfind(' ', start, end)
+            if space_pos > start:
+                end = space_pos
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        start = end - overlap if end < len(text) else end
+    return chunks
+
+
+def _random_text(seed):
+    rng = random.Random(seed)
+    words = ["olá", "ação", "x" * 50, "word", "ç" * 7, "\n", "😀", "\t中文"]
+    return " ".join(rng.choice(words) for _ in range(rng.randint(0, 2000)))
+
+
+class TestSplitTextIntoChunks:
+    def test_byte_offsets_non_ascii(self):
+        text = " ".join(["coração", "não", "ñandú", "😀", "中文"] * 300)
+        encoded = text.encode("utf-8")
+
+        chunks = _split_text_into_chunks(text)
+
+        assert len(chunks) > 1
+        for chunk, byte_start, byte_end in chunks:
+            assert encoded[byte_start:byte_end].decode("utf-8") == chunk
+
+    def test_byte_offsets_strip_whitespace(self):
+        text = "  \n\t" + " ".join(["ação"] * 600) + " \n\t  "
+        encoded = text.encode("utf-8")
+
+        chunks = _split_text_into_chunks(text)
+
+        for chunk, byte_start, byte_end in chunks:
+            assert chunk == chunk.strip()
+            assert encoded[byte_start:byte_end].decode("utf-8") == chunk
+
+    def test_short_text_spans_whole_text(self):
+        text = " ação curta "
+
+        assert _split_text_into_chunks(text) == [(text, 0, len(text.encode("utf-8")))]
+
+    @pytest.mark.parametrize("seed", range(20))
+    def test_boundaries_match_rfind(self, seed):
+        text = _random_text(seed)
+
+        chunks = [chunk for chunk, _, _ in _split_text_into_chunks(text)]
+
+        assert chunks == _rfind_chunks(text)
+
+
+class TestPointId:
+    def test_stable_and_distinct(self):
+        point_id = _point_id("documento", 3)
+
+        assert point_id == _point_id("documento", 3)
+        assert point_id != _point_id("documento", 4)
+        assert point_id != _point_id("outro", 3)
+        assert str(uuid.UUID(point_id)) == point_id
+
+
+class _StubS3Client:
+    def __init__(self, body):
+        self.body = body
+        self.calls = []
+
+    def get_object(self, **kwargs):
+        self.calls.append(kwargs)
+        return {"Body": io.BytesIO(self.body)}
+
+
+class TestLoadChunkText:
+    def test_requests_inclusive_byte_range(self):
+        s3_client = _StubS3Client("ação".encode("utf-8"))
+        payload = {"filename": "doc", "byte_start": 10, "byte_end": 16}
+
+        text = load_chunk_text(s3_client, "meu-bucket", payload)
+
+        assert text == "ação"
+        assert s3_client.calls == [{
+            "Bucket": "meu-bucket",
+            "Key": "intermedio/txt/doc.txt",
+            "Range": "bytes=10-15"
+        }]
+
+    def test_legacy_payload_returns_inline_text(self):
+        s3_client = _StubS3Client(b"")
+        payload = {"filename": "doc", "chunk_index": 0, "text": "texto antigo"}
+
+        assert load_chunk_text(s3_client, "meu-bucket", payload) == "texto antigo"
+        assert s3_client.calls == []
+
+    def test_empty_range_skips_request(self):
+        s3_client = _StubS3Client(b"")
+        payload = {"filename": "doc", "byte_start": 5, "byte_end": 5}
+
+        assert load_chunk_text(s3_client, "meu-bucket", payload) == ""
+        assert s3_client.calls == []
+
+
+class _StubQdrantClient:
+    def __init__(self, fail_on=None):
+        # fail_on: filename cujo batch deve falhar no upsert
+        self.fail_on = fail_on
+        self.upserts = []
+        self.deletes = []
+        self.lock = threading.Lock()
+
+    def get_collection(self, collection_name):
+        return None
+
+    def upsert(self, collection_name, points, wait):
+        if any(point.payload["filename"] == self.fail_on for point in points):
+            raise RuntimeError("qdrant indisponível")
+        with self.lock:
+            self.upserts.append((len(points), wait))
+
+    def delete(self, **kwargs):
+        self.deletes.append(kwargs)
+
+
+class _StubEmbedder:
+    def embed(self, chunks, batch_size):
+        for _ in chunks:
+            yield np.zeros(384, dtype=np.float32)
+
+
+def _run_embed_and_upsert(n_points, filename="doc"):
+    provenance = [(filename, i, n_points, 0, 1) for i in range(n_points)]
+    upserted = Counter()
+    nodes._embed_and_upsert(
+        _StubEmbedder(), "documents", 384, list(range(n_points)),
+        (str(i) for i in range(n_points)), provenance, upserted
+    )
+    return upserted
+
+
+class TestEmbedAndUpsert:
+    def test_only_last_batch_waits(self, monkeypatch):
+        client = _StubQdrantClient()
+        monkeypatch.setattr(nodes, "_qdrant", lambda: client)
+        n_points = 3 * nodes.UPSERT_BATCH + 10
+
+        upserted = _run_embed_and_upsert(n_points)
+
+        assert sum(size for size, _ in client.upserts) == n_points
+        assert [wait for _, wait in client.upserts].count(True) == 1
+        assert client.upserts[-1] == (10, True)
+        assert upserted == {"doc": n_points}
+
+    def test_consumer_error_is_reraised_without_deadlock(self, monkeypatch):
+        client = _StubQdrantClient(fail_on="doc")
+        monkeypatch.setattr(nodes, "_qdrant", lambda: client)
+        raised = []
+
+        def _run():
+            try:
+                _run_embed_and_upsert(20 * nodes.UPSERT_BATCH)
+            except RuntimeError as e:
+                raised.append(e)
+
+        runner = threading.Thread(target=_run, daemon=True)
+        runner.start()
+        runner.join(timeout=10)
+
+        assert not runner.is_alive()
+        assert [str(e) for e in raised] == ["qdrant indisponível"]
+        assert client.upserts == []
+
+
+class TestGenerateEmbeddingsAndUpsert:
+    def test_only_incomplete_documents_fail(self, monkeypatch):
+        client = _StubQdrantClient(fail_on="longo")
+        monkeypatch.setattr(nodes, "_qdrant", lambda: client)
+        monkeypatch.setattr(nodes, "_embedder", lambda: _StubEmbedder())
+        # Um ponto por batch e um consumidor: ordem de upsert determinística
+        monkeypatch.setattr(nodes, "UPSERT_BATCH", 1)
+        monkeypatch.setattr(nodes, "UPSERT_WORKERS", 1)
+        texts = {"curto": "texto curto", "longo": "palavra " * 400}
+        n_longo = len(_split_text_into_chunks(texts["longo"]))
+
+        embedding_report, collections_used = nodes.generate_embeddings_and_upsert(texts, {})
+
+        assert embedding_report["processed_documents"] == [
+            {"filename": "curto", "chunks_created": 1, "status": "success"}
+        ]
+        assert [d["filename"] for d in embedding_report["failed_documents"]] == ["longo"]
+        assert f"0/{n_longo} chunks" in embedding_report["failed_documents"][0]["error"]
+        assert embedding_report["total_vectors_created"] == 1
+        assert collections_used["collection_details"]["documents"]["documents_added"] == 1
+
+        # A limpeza de pontos antigos só considera o documento completo
+        (delete,) = client.deletes
+        (doc_filter,) = delete["points_selector"].filter.should
+        assert doc_filter.must[0].match.value == "curto"
+
+
+class TestDeleteStalePoints:
+    def test_filter_keeps_only_this_run_ids(self, monkeypatch):
+        client = _StubQdrantClient()
+        monkeypatch.setattr(nodes, "_qdrant", lambda: client)
+
+        nodes._delete_stale_points("documents", [("a", 2), ("b", 1)])
+
+        (delete,) = client.deletes
+        assert delete["wait"] is True
+        doc_filters = delete["points_selector"].filter.should
+        assert [f.must[0].key for f in doc_filters] == ["filename", "filename"]
+        assert [f.must[0].match.value for f in doc_filters] == ["a", "b"]
+        assert doc_filters[0].must_not[0].has_id == [_point_id("a", 0), _point_id("a", 1)]
+        assert doc_filters[1].must_not[0].has_id == [_point_id("b", 0)]
+
+    def test_no_documents_skips_request(self, monkeypatch):
+        client = _StubQdrantClient()
+        monkeypatch.setattr(nodes, "_qdrant", lambda: client)
+
+        nodes._delete_stale_points("documents", [])
+
+        assert client.deletes == []
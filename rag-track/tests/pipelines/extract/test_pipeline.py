@@ -7,3 +7,158 @@ Kedro recommends using `pytest` framework, more info about it can be found
 in the official documentation:
 https://docs.pytest.org/en/latest/getting-started.html
 """
+import io
+import random
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from rag_track.pipelines.extract import nodes
+
+
+class _StubS3Client:
+    def __init__(self, missing=()):
+        self.missing = set(missing)
+        self.uploads = {}
+        self.lock = threading.Lock()
+
+    def get_object(self, Bucket, Key):
+        # Latência aleatória para os downloads terminarem fora de ordem
+        time.sleep(random.uniform(0, 0.01))
+        if Key in self.missing:
+            raise KeyError(Key)
+        return {"Body": io.BytesIO(Key.encode("utf-8"))}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        with self.lock:
+            self.uploads[Key] = Body
+
+
+class _FakeDocument:
+    def __init__(self, text):
+        self.document = self
+        self.text = text
+
+    def export_to_markdown(self):
+        return self.text
+
+
+class _FakeConverter:
+    def convert(self, source):
+        data = source.stream.read()
+        if data.startswith(b"bad"):
+            raise ValueError("pdf corrompido")
+        return _FakeDocument(f"texto de {source.name}")
+
+
+class _InlineExecutor:
+    """Substitui o ProcessPoolExecutor, convertendo na própria thread"""
+
+    def __init__(self, max_workers=None, mp_context=None, initializer=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class _BrokenExecutor(_InlineExecutor):
+    """Simula um worker do docling morto ao converter kill.pdf"""
+
+    def submit(self, fn, *args):
+        if args[0] == "kill.pdf":
+            future = Future()
+            future.set_exception(BrokenProcessPool("worker morreu"))
+            return future
+        return super().submit(fn, *args)
+
+
+class _Abort(BaseException):
+    pass
+
+
+class _AbortingExecutor(_InlineExecutor):
+    def submit(self, fn, *args):
+        raise _Abort()
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    client = _StubS3Client(missing={"raw/pdfs/missing.pdf"})
+    monkeypatch.setattr(nodes, "_s3_client", lambda: client)
+    monkeypatch.setattr(nodes, "_converter", lambda: _FakeConverter())
+    return client
+
+
+class TestConvertPdfsToText:
+    def test_results_follow_pdf_files_order(self, s3_client, monkeypatch):
+        monkeypatch.setattr(nodes, "ProcessPoolExecutor", _InlineExecutor)
+        pdf_files = [f"raw/pdfs/doc{i}.pdf" for i in range(20)]
+
+        result = nodes.convert_pdfs_to_text(pdf_files)
+
+        index = result["converted_index"]
+        assert [f["original_pdf"] for f in index["converted_files"]] == pdf_files
+        assert result["texts_partitioned"]["doc3"] == "texto de doc3.pdf"
+        assert "intermedio/txt/doc3.txt" in s3_client.uploads
+        assert index["total_successful"] == 20
+
+    def test_download_and_conversion_errors_recorded(self, s3_client, monkeypatch):
+        monkeypatch.setattr(nodes, "ProcessPoolExecutor", _InlineExecutor)
+        pdf_files = ["raw/pdfs/a.pdf", "raw/pdfs/missing.pdf", "bad.pdf"]
+
+        result = nodes.convert_pdfs_to_text(pdf_files)
+
+        index = result["converted_index"]
+        assert [f["original_pdf"] for f in index["converted_files"]] == ["raw/pdfs/a.pdf"]
+        assert [f["original_pdf"] for f in index["failed_files"]] == [
+            "raw/pdfs/missing.pdf", "bad.pdf"
+        ]
+        assert "pdf corrompido" in index["failed_files"][1]["error"]
+        assert index["total_processed"] == 3
+        assert index["total_failed"] == 2
+
+    def test_broken_process_pool_fails_only_that_pdf(self, s3_client, monkeypatch):
+        monkeypatch.setattr(nodes, "ProcessPoolExecutor", _BrokenExecutor)
+        pdf_files = ["raw/pdfs/a.pdf", "kill.pdf", "raw/pdfs/b.pdf"]
+
+        result = nodes.convert_pdfs_to_text(pdf_files)
+
+        index = result["converted_index"]
+        assert index["total_successful"] == 2
+        assert index["failed_files"] == [{
+            "original_pdf": "kill.pdf",
+            "error": "worker morreu",
+            "status": "failed"
+        }]
+
+    def test_abort_drains_downloads_instead_of_hanging(self, s3_client, monkeypatch):
+        monkeypatch.setattr(nodes, "ProcessPoolExecutor", _AbortingExecutor)
+        pdf_files = [f"raw/pdfs/doc{i}.pdf" for i in range(5 * nodes.PREFETCH_PDFS)]
+        raised = []
+
+        def _run():
+            try:
+                nodes.convert_pdfs_to_text(pdf_files)
+            except _Abort as e:
+                raised.append(e)
+
+        runner = threading.Thread(target=_run, daemon=True)
+        runner.start()
+        runner.join(timeout=10)
+
+        assert not runner.is_alive()
+        assert len(raised) == 1